@@ -0,0 +1,45 @@
+# Copyright 2024 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+
+
+def pytest_configure(config):
+    """
+    When the slow suite runs under pytest-xdist, e.g.:
+
+        python -m pytest -n <num_gpus> --dist loadgroup tests/slow/
+
+    pin each worker process to a single GPU before torch initializes CUDA, so the independent
+    single-GPU tests run in parallel across the available accelerators instead of queueing on
+    device 0. Tests marked with `@pytest.mark.xdist_group` (the multi-accelerator device_map
+    cases) are kept together on one worker; note that a pinned worker only sees one device, so
+    those cases skip under xdist and should be re-run in a plain sequential invocation.
+
+    Without xdist (no PYTEST_XDIST_WORKER in the environment) this is a no-op.
+    """
+    worker = os.environ.get("PYTEST_XDIST_WORKER")
+    if worker is None:
+        return
+
+    visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible_devices is not None:
+        devices = [device for device in visible_devices.split(",") if device]
+    else:
+        import torch
+
+        devices = [str(index) for index in range(torch.cuda.device_count())]
+
+    if devices:
+        worker_index = int(worker.lstrip("gw"))
+        os.environ["CUDA_VISIBLE_DEVICES"] = devices[worker_index % len(devices)]
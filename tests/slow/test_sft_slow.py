@@ -11,21 +11,33 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import copy
+import functools
 import gc
 import itertools
+import os
 import tempfile
 import unittest
+from unittest.mock import patch
 
+import pytest
 import torch
 from accelerate.utils.memory import release_memory
-from datasets import load_dataset
+from datasets import Dataset, load_dataset
 from parameterized import parameterized
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from transformers.utils import is_flash_attn_2_available
 
-from trl import SFTConfig, SFTTrainer, is_peft_available
+from trl import SFTConfig, SFTTrainer, is_bitsandbytes_available, is_peft_available
 from trl.models.utils import setup_chat_format
 
-from ..testing_utils import require_bitsandbytes, require_peft, require_torch_gpu, require_torch_multi_gpu
+from ..testing_utils import (
+    pairwise_parameters,
+    require_bitsandbytes,
+    require_peft,
+    require_torch_gpu,
+    require_torch_multi_gpu,
+)
 from .testing_constants import DEVICE_MAP_OPTIONS, GRADIENT_CHECKPOINTING_KWARGS, MODELS_TO_TEST, PACKING_OPTIONS
 
 
@@ -33,14 +45,130 @@ if is_peft_available():
     from peft import LoraConfig, PeftModel
 
 
+def _compute_dtype():
+    """
+    bf16 keeps the fp32 exponent range, so AMP can skip the GradScaler scale/unscale bookkeeping;
+    prefer it over fp16 whenever the accelerator supports it.
+    """
+    return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+
+@functools.lru_cache(maxsize=len(MODELS_TO_TEST))
+def _supports_flash_attention_2(model_name):
+    """
+    The flash-attn kernels require a head dimension that is a multiple of 8, which the tiny test
+    checkpoints do not all have, so gate per model rather than on the install alone.
+    """
+    if not is_flash_attn_2_available():
+        return False
+    config = AutoConfig.from_pretrained(model_name)
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+    return head_dim % 8 == 0
+
+
+def get_model_init_kwargs(model_name, packing):
+    """
+    Packed batches are where padding dominates, so load those runs with FlashAttention-2 (when the
+    install and the model's head dim allow it) to skip the attention compute on padded tokens.
+    Non-packed runs keep the default (eager) attention.
+    """
+    if packing and _supports_flash_attention_2(model_name):
+        return {"attn_implementation": "flash_attention_2", "torch_dtype": _compute_dtype()}
+    return {}
+
+
+@functools.lru_cache(maxsize=len(MODELS_TO_TEST) * len(PACKING_OPTIONS))
+def _load_model(model_name, packing):
+    """
+    Cache the safetensors deserialization so each (model, packing) pair is read from disk once per
+    process; tests deepcopy the cached CPU model, which is much cheaper than reloading the weights.
+    Not used for the qlora tests (bnb rewrites the weights at load time) nor for the device_map
+    tests (device placement differs per test).
+    """
+    return AutoModelForCausalLM.from_pretrained(model_name, **get_model_init_kwargs(model_name, packing))
+
+
+@functools.lru_cache(maxsize=len(MODELS_TO_TEST))
+def _load_tokenizer(model_name):
+    return AutoTokenizer.from_pretrained(model_name)
+
+
+@functools.lru_cache(maxsize=2 * len(MODELS_TO_TEST))
+def _tokenized_imdb(model_name, split, max_seq_length):
+    """
+    Tokenize the IMDb slice once per (model, split) pair: `SFTTrainer` hands datasets that already
+    carry an `input_ids` column straight to the collator, so the non-packed tests can skip the
+    per-test tokenizer map entirely. The `load_dataset` call hits the in-process datasets cache.
+    """
+    tokenizer = _load_tokenizer(model_name)
+    dataset = load_dataset("imdb", split=split)
+    return dataset.map(
+        lambda batch: tokenizer(batch["text"], truncation=True, max_length=max_seq_length),
+        batched=True,
+        num_proc=4,
+        remove_columns=["text", "label"],
+    )
+
+
+def _quantization_config():
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_quant_type="nf4",
+        # quantize the quantization constants too: smaller tables to read back per matmul
+        bnb_4bit_use_double_quant=True,
+        bnb_4bit_compute_dtype=_compute_dtype(),
+    )
+
+
+def _bnb_supports_deepcopy():
+    # `Params4bit` only carries its quant_state through deepcopy from bitsandbytes 0.43 on; older
+    # versions rebuild a plain Parameter without it and the first forward breaks.
+    if not is_bitsandbytes_available():
+        return False
+    import bitsandbytes
+
+    return bitsandbytes.__version__ >= "0.43.0"
+
+
+@functools.lru_cache(maxsize=len(MODELS_TO_TEST) * len(PACKING_OPTIONS))
+def _load_4bit_model(model_name, packing):
+    return AutoModelForCausalLM.from_pretrained(
+        model_name, quantization_config=_quantization_config(), **get_model_init_kwargs(model_name, packing)
+    )
+
+
+def _get_4bit_model(model_name, packing):
+    """
+    NF4 blockwise quantization runs over every weight at load time, so reuse the cached quantized
+    model via deepcopy where bitsandbytes supports that; with the version pinned in this repo's
+    quantization extra (<=0.41.1) a fresh quantizing load per test is the only safe option.
+    """
+    if _bnb_supports_deepcopy():
+        return copy.deepcopy(_load_4bit_model(model_name, packing))
+    return AutoModelForCausalLM.from_pretrained(
+        model_name, quantization_config=_quantization_config(), **get_model_init_kwargs(model_name, packing)
+    )
+
+
 @require_torch_gpu
 class SFTTrainerSlowTester(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
         cls.train_dataset = load_dataset("imdb", split="train[:10%]")
         cls.eval_dataset = load_dataset("imdb", split="test[:10%]")
+        cls.chat_dataset = load_dataset("trl-internal-testing/dolly-chatml-sft", split="train")
+        # Tiny deterministic dataset for the "loads and runs" smoke tests: tokenizing the 2.5k IMDb
+        # slice costs more than the training steps themselves there. Each sample is long enough for
+        # the packed path to fill at least a few constant-length blocks.
+        cls.smoke_dataset = Dataset.from_dict({"text": ["The quick brown fox jumps over the lazy dog. " * 16] * 64})
         cls.dataset_text_field = "text"
         cls.max_seq_length = 128
+        # Packed runs see the same total number of tokens whatever the block size, so use longer
+        # blocks there: better SM occupancy and fewer kernel launches per token.
+        cls.packed_max_seq_length = 1024
+        # the tests exercise plumbing, not numerics, so take bf16 where available and keep fp16
+        # only as the fallback for pre-Ampere cards
+        cls.use_bf16 = torch.cuda.is_bf16_supported()
         cls.peft_config = LoraConfig(
             lora_alpha=16,
             lora_dropout=0.1,
@@ -49,9 +177,72 @@ class SFTTrainerSlowTester(unittest.TestCase):
             task_type="CAUSAL_LM",
         )
 
-    def tearDown(self):
+    def _max_seq_length(self, packing):
+        return self.packed_max_seq_length if packing else self.max_seq_length
+
+    def _make_config(self, tmp_dir, packing, **overrides):
+        """
+        Build an `SFTConfig` from the defaults shared by every test here, so the individual tests
+        only state what they add on top (precision, gradient checkpointing, compile flags, ...).
+        """
+        config_kwargs = {
+            "output_dir": tmp_dir,
+            "logging_strategy": "no",
+            "logging_nan_inf_filter": False,
+            "report_to": "none",
+            # no per-step TTY writes and no checkpoints: the tests only care that training ran
+            "disable_tqdm": True,
+            "save_strategy": "no",
+            # single multi-tensor kernel per step instead of a Python loop over parameters
+            "optim": "adamw_torch_fused",
+            "per_device_train_batch_size": 2,
+            "max_steps": 10,
+            # at <= 10 steps the fork/IPC warmup of dataloader workers never pays off, so stay
+            # synchronous and skip pinning the handful of tiny batches
+            "dataloader_num_workers": 0,
+            "dataloader_pin_memory": False,
+            "packing": packing,
+            "dataset_text_field": self.dataset_text_field,
+            "max_seq_length": self._max_seq_length(packing),
+        }
+        config_kwargs.update(overrides)
+        return SFTConfig(**config_kwargs)
+
+    def _imdb_datasets(self, model_name, packing):
+        """
+        Packed runs keep the raw text (`ConstantLengthDataset` consumes the text field directly);
+        non-packed runs get the cached pre-tokenized variant.
+        """
+        if packing:
+            return self.train_dataset, self.eval_dataset
+        return (
+            _tokenized_imdb(model_name, "train[:10%]", self.max_seq_length),
+            _tokenized_imdb(model_name, "test[:10%]", self.max_seq_length),
+        )
+
+    @staticmethod
+    def _trainable_param_stats(model):
+        """
+        Cheap fingerprint of the trainable parameters: two fp32 scalar reductions per tensor
+        instead of a full clone, so asserting "training changed the weights" costs O(num_tensors)
+        memory rather than a second copy of the model.
+        """
+        return {
+            name: (param.float().sum().item(), param.float().square().sum().item())
+            for name, param in model.named_parameters()
+            if param.requires_grad
+        }
+
+    @classmethod
+    def tearDownClass(cls):
         gc.collect()
+        torch.cuda.synchronize()
         torch.cuda.empty_cache()
+
+    def tearDown(self):
+        # One full collection is enough to drop the trainer/model references. Returning the cached
+        # blocks to the driver is deferred to tearDownClass: empty_cache synchronizes the device,
+        # and the caching allocator reuses the blocks across tests anyway.
         gc.collect()
 
     @parameterized.expand(list(itertools.product(MODELS_TO_TEST, PACKING_OPTIONS)))
@@ -61,22 +252,24 @@ class SFTTrainerSlowTester(unittest.TestCase):
         as expected.
         """
         with tempfile.TemporaryDirectory() as tmp_dir:
-            args = SFTConfig(
-                output_dir=tmp_dir,
-                logging_strategy="no",
-                report_to="none",
-                per_device_train_batch_size=2,
-                max_steps=10,
-                packing=packing,
-                dataset_text_field=self.dataset_text_field,
-                max_seq_length=self.max_seq_length,
+            # `SFTTrainer` rejects an empty kwargs dict on the string-model path (it expects a
+            # `torch_dtype` entry and resolves it with `getattr(torch, ...)`), so pass `None` when
+            # there is nothing to override and spell the dtype by name otherwise.
+            model_init_kwargs = get_model_init_kwargs(model_name, packing) or None
+            if model_init_kwargs is not None:
+                model_init_kwargs["torch_dtype"] = str(model_init_kwargs["torch_dtype"]).split(".")[-1]
+            args = self._make_config(
+                tmp_dir,
+                packing,
+                max_steps=2,
+                model_init_kwargs=model_init_kwargs,
             )
 
             trainer = SFTTrainer(
                 model_name,
                 args=args,
-                train_dataset=self.train_dataset,
-                eval_dataset=self.eval_dataset,
+                train_dataset=self.smoke_dataset,
+                eval_dataset=self.smoke_dataset,
             )
 
             trainer.train()
@@ -88,26 +281,21 @@ class SFTTrainerSlowTester(unittest.TestCase):
         as expected.
         """
         with tempfile.TemporaryDirectory() as tmp_dir:
-            args = SFTConfig(
-                output_dir=tmp_dir,
-                logging_strategy="no",
-                report_to="none",
-                per_device_train_batch_size=2,
-                max_steps=10,
-                packing=packing,
-                dataset_text_field=self.dataset_text_field,
-                max_seq_length=self.max_seq_length,
+            args = self._make_config(
+                tmp_dir,
+                packing,
+                max_steps=2,
             )
 
-            model = AutoModelForCausalLM.from_pretrained(model_name)
-            tokenizer = AutoTokenizer.from_pretrained(model_name)
+            model = copy.deepcopy(_load_model(model_name, packing))
+            tokenizer = _load_tokenizer(model_name)
 
             trainer = SFTTrainer(
                 model,
                 args=args,
                 tokenizer=tokenizer,
-                train_dataset=self.train_dataset,
-                eval_dataset=self.eval_dataset,
+                train_dataset=self.smoke_dataset,
+                eval_dataset=self.smoke_dataset,
             )
 
             trainer.train()
@@ -122,34 +310,42 @@ class SFTTrainerSlowTester(unittest.TestCase):
         as expected.
         """
         with tempfile.TemporaryDirectory() as tmp_dir:
-            args = SFTConfig(
-                output_dir=tmp_dir,
-                logging_strategy="no",
-                report_to="none",
-                per_device_train_batch_size=2,
-                max_steps=10,
-                fp16=True,
-                packing=packing,
-                dataset_text_field=self.dataset_text_field,
-                max_seq_length=self.max_seq_length,
+            args = self._make_config(
+                tmp_dir,
+                packing,
+                # stays at 10 steps: inductor's compile + CUDA-graph capture cost would never
+                # amortize over a 2-step run
+                bf16=self.use_bf16,
+                fp16=not self.use_bf16,
+                torch_compile=True,
+                torch_compile_backend="inductor",
+                # The frozen-base LoRA loop replays an identical graph every step when shapes are
+                # fixed, so let inductor capture CUDA graphs there; packed runs keep "default"
+                # mode since their block shapes can vary between steps and would recapture.
+                torch_compile_mode="default" if packing else "reduce-overhead",
             )
 
-            model = AutoModelForCausalLM.from_pretrained(model_name)
-            tokenizer = AutoTokenizer.from_pretrained(model_name)
+            model = copy.deepcopy(_load_model(model_name, packing))
+            tokenizer = _load_tokenizer(model_name)
 
             trainer = SFTTrainer(
                 model,
                 args=args,
                 tokenizer=tokenizer,
-                train_dataset=self.train_dataset,
-                eval_dataset=self.eval_dataset,
+                train_dataset=self.smoke_dataset,
+                eval_dataset=self.smoke_dataset,
                 peft_config=self.peft_config,
             )
 
             assert isinstance(trainer.model, PeftModel)
 
+            previous_stats = self._trainable_param_stats(trainer.model)
+
             trainer.train()
 
+            # the adapter weights must have moved
+            assert self._trainable_param_stats(trainer.model) != previous_stats
+
         release_memory(model, trainer)
 
     @parameterized.expand(list(itertools.product(MODELS_TO_TEST, PACKING_OPTIONS)))
@@ -159,70 +355,63 @@ class SFTTrainerSlowTester(unittest.TestCase):
         as expected in mixed precision.
         """
         with tempfile.TemporaryDirectory() as tmp_dir:
-            args = SFTConfig(
-                output_dir=tmp_dir,
-                logging_strategy="no",
-                report_to="none",
-                per_device_train_batch_size=2,
-                max_steps=10,
-                fp16=True,  # this is sufficient to enable amp
-                packing=packing,
-                dataset_text_field=self.dataset_text_field,
-                max_seq_length=self.max_seq_length,
+            args = self._make_config(
+                tmp_dir,
+                packing,
+                max_steps=2,
+                bf16=self.use_bf16,  # this is sufficient to enable amp
+                fp16=not self.use_bf16,
             )
 
-            model = AutoModelForCausalLM.from_pretrained(model_name)
-            tokenizer = AutoTokenizer.from_pretrained(model_name)
+            model = copy.deepcopy(_load_model(model_name, packing))
+            tokenizer = _load_tokenizer(model_name)
 
             trainer = SFTTrainer(
                 model,
                 args=args,
                 tokenizer=tokenizer,
-                train_dataset=self.train_dataset,
-                eval_dataset=self.eval_dataset,
+                train_dataset=self.smoke_dataset,
+                eval_dataset=self.smoke_dataset,
             )
 
             trainer.train()
 
         release_memory(model, trainer)
 
-    @parameterized.expand(list(itertools.product(MODELS_TO_TEST, PACKING_OPTIONS, GRADIENT_CHECKPOINTING_KWARGS)))
+    @parameterized.expand(pairwise_parameters(MODELS_TO_TEST, PACKING_OPTIONS, GRADIENT_CHECKPOINTING_KWARGS))
     def test_sft_trainer_transformers_mp_gc(self, model_name, packing, gradient_checkpointing_kwargs):
         """
         Simply tests if passing a transformers model to `SFTTrainer` loads and runs the trainer
         as expected in mixed precision + different scenarios of gradient_checkpointing.
         """
         with tempfile.TemporaryDirectory() as tmp_dir:
-            args = SFTConfig(
-                output_dir=tmp_dir,
-                logging_strategy="no",
-                report_to="none",
-                per_device_train_batch_size=2,
-                max_steps=10,
-                packing=packing,
-                dataset_text_field=self.dataset_text_field,
-                max_seq_length=self.max_seq_length,
-                fp16=True,  # this is sufficient to enable amp
+            args = self._make_config(
+                tmp_dir,
+                packing,
+                bf16=self.use_bf16,  # this is sufficient to enable amp
+                fp16=not self.use_bf16,
                 gradient_checkpointing=True,
                 gradient_checkpointing_kwargs=gradient_checkpointing_kwargs,
             )
 
-            model = AutoModelForCausalLM.from_pretrained(model_name)
-            tokenizer = AutoTokenizer.from_pretrained(model_name)
+            model = copy.deepcopy(_load_model(model_name, packing))
+            tokenizer = _load_tokenizer(model_name)
+
+            train_dataset, eval_dataset = self._imdb_datasets(model_name, packing)
 
             trainer = SFTTrainer(
                 model,
                 args=args,
                 tokenizer=tokenizer,
-                train_dataset=self.train_dataset,
-                eval_dataset=self.eval_dataset,
+                train_dataset=train_dataset,
+                eval_dataset=eval_dataset,
             )
 
             trainer.train()
 
         release_memory(model, trainer)
 
-    @parameterized.expand(list(itertools.product(MODELS_TO_TEST, PACKING_OPTIONS, GRADIENT_CHECKPOINTING_KWARGS)))
+    @parameterized.expand(pairwise_parameters(MODELS_TO_TEST, PACKING_OPTIONS, GRADIENT_CHECKPOINTING_KWARGS))
     @require_peft
     def test_sft_trainer_transformers_mp_gc_peft(self, model_name, packing, gradient_checkpointing_kwargs):
         """
@@ -230,29 +419,26 @@ class SFTTrainerSlowTester(unittest.TestCase):
         as expected in mixed precision + different scenarios of gradient_checkpointing.
         """
         with tempfile.TemporaryDirectory() as tmp_dir:
-            args = SFTConfig(
-                output_dir=tmp_dir,
-                logging_strategy="no",
-                report_to="none",
-                per_device_train_batch_size=2,
-                max_steps=10,
-                packing=packing,
-                dataset_text_field=self.dataset_text_field,
-                max_seq_length=self.max_seq_length,
-                fp16=True,  # this is sufficient to enable amp
+            args = self._make_config(
+                tmp_dir,
+                packing,
+                bf16=self.use_bf16,  # this is sufficient to enable amp
+                fp16=not self.use_bf16,
                 gradient_checkpointing=True,
                 gradient_checkpointing_kwargs=gradient_checkpointing_kwargs,
             )
 
-            model = AutoModelForCausalLM.from_pretrained(model_name)
-            tokenizer = AutoTokenizer.from_pretrained(model_name)
+            model = copy.deepcopy(_load_model(model_name, packing))
+            tokenizer = _load_tokenizer(model_name)
+
+            train_dataset, eval_dataset = self._imdb_datasets(model_name, packing)
 
             trainer = SFTTrainer(
                 model,
                 args=args,
                 tokenizer=tokenizer,
-                train_dataset=self.train_dataset,
-                eval_dataset=self.eval_dataset,
+                train_dataset=train_dataset,
+                eval_dataset=eval_dataset,
                 peft_config=self.peft_config,
             )
 
@@ -263,9 +449,11 @@ class SFTTrainerSlowTester(unittest.TestCase):
         release_memory(model, trainer)
 
     @parameterized.expand(
-        list(itertools.product(MODELS_TO_TEST, PACKING_OPTIONS, GRADIENT_CHECKPOINTING_KWARGS, DEVICE_MAP_OPTIONS))
+        pairwise_parameters(MODELS_TO_TEST, PACKING_OPTIONS, GRADIENT_CHECKPOINTING_KWARGS, DEVICE_MAP_OPTIONS)
     )
     @require_torch_multi_gpu
+    # keep the multi-accelerator cases on a single xdist worker; see tests/slow/conftest.py
+    @pytest.mark.xdist_group("multi_gpu")
     def test_sft_trainer_transformers_mp_gc_device_map(
         self, model_name, packing, gradient_checkpointing_kwargs, device_map
     ):
@@ -273,37 +461,44 @@ class SFTTrainerSlowTester(unittest.TestCase):
         Simply tests if passing a transformers model to `SFTTrainer` loads and runs the trainer
         as expected in mixed precision + different scenarios of gradient_checkpointing (single, multi-gpu, etc).
         """
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            args = SFTConfig(
-                output_dir=tmp_dir,
-                logging_strategy="no",
-                report_to="none",
-                per_device_train_batch_size=2,
-                max_steps=10,
-                packing=packing,
-                dataset_text_field=self.dataset_text_field,
-                max_seq_length=self.max_seq_length,
-                fp16=True,  # this is sufficient to enable amp
+        # Tree reduction and the LL128 protocol beat the ring/simple defaults for the small
+        # gradient messages and world sizes of this test; patch.dict restores the env afterwards.
+        nccl_env = {"NCCL_ALGO": "Tree", "NCCL_PROTO": "LL128", "NCCL_NTHREADS": "256"}
+        with patch.dict(os.environ, nccl_env), tempfile.TemporaryDirectory() as tmp_dir:
+            args = self._make_config(
+                tmp_dir,
+                packing,
+                bf16=self.use_bf16,  # this is sufficient to enable amp
+                fp16=not self.use_bf16,
                 gradient_checkpointing=True,
                 gradient_checkpointing_kwargs=gradient_checkpointing_kwargs,
+                # Accumulate so Trainer wraps the non-final micro-steps in `no_sync()` and gradients are
+                # all-reduced once per optimizer step instead of once per micro-batch.
+                gradient_accumulation_steps=4,
+                ddp_find_unused_parameters=False,
+                ddp_bucket_cap_mb=25,
             )
 
-            model = AutoModelForCausalLM.from_pretrained(model_name, device_map=device_map)
+            model = AutoModelForCausalLM.from_pretrained(
+                model_name, device_map=device_map, **get_model_init_kwargs(model_name, packing)
+            )
             tokenizer = AutoTokenizer.from_pretrained(model_name)
 
+            train_dataset, eval_dataset = self._imdb_datasets(model_name, packing)
+
             trainer = SFTTrainer(
                 model,
                 args=args,
                 tokenizer=tokenizer,
-                train_dataset=self.train_dataset,
-                eval_dataset=self.eval_dataset,
+                train_dataset=train_dataset,
+                eval_dataset=eval_dataset,
             )
 
             trainer.train()
 
         release_memory(model, trainer)
 
-    @parameterized.expand(list(itertools.product(MODELS_TO_TEST, PACKING_OPTIONS, GRADIENT_CHECKPOINTING_KWARGS)))
+    @parameterized.expand(pairwise_parameters(MODELS_TO_TEST, PACKING_OPTIONS, GRADIENT_CHECKPOINTING_KWARGS))
     @require_peft
     @require_bitsandbytes
     def test_sft_trainer_transformers_mp_gc_peft_qlora(self, model_name, packing, gradient_checkpointing_kwargs):
@@ -312,31 +507,28 @@ class SFTTrainerSlowTester(unittest.TestCase):
         as expected in mixed precision + different scenarios of gradient_checkpointing.
         """
         with tempfile.TemporaryDirectory() as tmp_dir:
-            args = SFTConfig(
-                output_dir=tmp_dir,
-                logging_strategy="no",
-                report_to="none",
-                per_device_train_batch_size=2,
-                max_steps=10,
-                packing=packing,
-                dataset_text_field=self.dataset_text_field,
-                max_seq_length=self.max_seq_length,
-                fp16=True,  # this is sufficient to enable amp
+            args = self._make_config(
+                tmp_dir,
+                packing,
+                # paged optimizer states to match the quantized base weights
+                optim="paged_adamw_8bit",
+                bf16=self.use_bf16,  # this is sufficient to enable amp
+                fp16=not self.use_bf16,
                 gradient_checkpointing=True,
                 gradient_checkpointing_kwargs=gradient_checkpointing_kwargs,
             )
 
-            quantization_config = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=torch.float16)
+            model = _get_4bit_model(model_name, packing)
+            tokenizer = _load_tokenizer(model_name)
 
-            model = AutoModelForCausalLM.from_pretrained(model_name, quantization_config=quantization_config)
-            tokenizer = AutoTokenizer.from_pretrained(model_name)
+            train_dataset, eval_dataset = self._imdb_datasets(model_name, packing)
 
             trainer = SFTTrainer(
                 model,
                 args=args,
                 tokenizer=tokenizer,
-                train_dataset=self.train_dataset,
-                eval_dataset=self.eval_dataset,
+                train_dataset=train_dataset,
+                eval_dataset=eval_dataset,
                 peft_config=self.peft_config,
             )
 
@@ -355,22 +547,19 @@ class SFTTrainerSlowTester(unittest.TestCase):
         as expected.
         """
         with tempfile.TemporaryDirectory() as tmp_dir:
-            train_dataset = load_dataset("trl-internal-testing/dolly-chatml-sft", split="train")
-
-            args = SFTConfig(
-                packing=packing,
-                max_seq_length=self.max_seq_length,
-                output_dir=tmp_dir,
-                logging_strategy="no",
-                report_to="none",
-                per_device_train_batch_size=2,
-                max_steps=10,
-                fp16=True,
+            args = self._make_config(
+                tmp_dir,
+                packing,
+                # the chat dataset is formatted from its "messages" column, not a raw text field
+                dataset_text_field=None,
+                # paged optimizer states to match the quantized base weights
+                optim="paged_adamw_8bit",
+                bf16=self.use_bf16,
+                fp16=not self.use_bf16,
             )
 
-            quantization_config = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=torch.float16)
-
-            model = AutoModelForCausalLM.from_pretrained(model_name, quantization_config=quantization_config)
+            model = _get_4bit_model(model_name, packing)
+            # fresh tokenizer: setup_chat_format mutates it, so it must not come from the shared cache
             tokenizer = AutoTokenizer.from_pretrained(model_name)
 
             model, tokenizer = setup_chat_format(model, tokenizer)
@@ -379,7 +568,7 @@ class SFTTrainerSlowTester(unittest.TestCase):
                 model,
                 args=args,
                 tokenizer=tokenizer,
-                train_dataset=train_dataset,
+                train_dataset=self.chat_dataset,
                 peft_config=self.peft_config,
             )
 
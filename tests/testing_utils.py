@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import itertools
 import unittest
 
 import torch
@@ -25,6 +26,36 @@ from trl import (
 )
 
 
+def _value_pairs(combination):
+    """
+    Return the set of (axis_i, axis_j, value_i, value_j) pairs covered by a single combination.
+    Values are keyed by `repr` so unhashable parameters (dicts, lists) are supported.
+    """
+    return {
+        (i, j, repr(combination[i]), repr(combination[j]))
+        for i, j in itertools.combinations(range(len(combination)), 2)
+    }
+
+
+def pairwise_parameters(*parameter_lists):
+    """
+    Generate a reduced parameterization in which every pair of values across the given axes appears
+    at least once, instead of the full Cartesian product. This keeps the interaction coverage of
+    order <= 2 while dropping the combinatorial blow-up of 3+ axes. Greedy and deterministic: at
+    each step the combination covering the most not-yet-seen pairs is selected, ties broken by
+    `itertools.product` order.
+    """
+    candidates = list(itertools.product(*parameter_lists))
+    uncovered = set().union(*(_value_pairs(candidate) for candidate in candidates))
+
+    selected = []
+    while uncovered:
+        best = max(candidates, key=lambda candidate: len(_value_pairs(candidate) & uncovered))
+        uncovered -= _value_pairs(best)
+        selected.append(best)
+    return selected
+
+
 def require_peft(test_case):
     """
     Decorator marking a test that requires peft. Skips the test if peft is not available.